@@ -4,6 +4,9 @@ these suffixes:
     -ms.csv   : Market Share
     -tgr.csv  : Total Gold Rank
 
+and with the -t option, a third:
+    -ts.csv   : Running totals and trailing windows over time
+
 Use the -i option to print out instructions for updating the Tableau quarterly
 report for elves.
 """
@@ -11,40 +14,85 @@ import optparse
 import sys
 import os
 import csv
+import collections
+import copy
+import hashlib
+import heapq
+import itertools
+import operator
+import shutil
+import tempfile
+import zipfile
+from xml.etree import cElementTree
 from decimal import Decimal, ROUND_HALF_UP
 import logging
 log = logging.getLogger(__name__)
 from datetime import datetime
+from sharded_csv import ShardedWriter
+try:
+    # only for peak_memory_kb, there is no resource module on Windows
+    import resource
+except ImportError:
+    resource = None
 
 
 class GetDataSet(object):
     """Extract certain fields from a csv file and create a new csv.
     """
 
-    def __init__(self, csv_filename, date_start=None, date_end=None):
+    def __init__(self, csv_filename, date_start=None, date_end=None,
+                 max_keys=None):
         self.fieldnames_in = None
         self.fieldnames_out = None
-        self.csv_filename = csv_filename
+        # a directory is a month partitioned data set, see partition_by_month
+        self.csv_filename = os.path.normpath(csv_filename)
         self.new_csv_name = None
         self.list_of_dicts = None
         self.get_rows = self.get_csv_bits
+        # spill the aggregation to disk past this many keys, see SpillingTotals
+        self.max_keys = max_keys
         self.mining_date_start = datetime.strptime(
             date_start, '%Y-%m-%d').date() if date_start else None
         self.mining_date_end = datetime.strptime(
             date_end, '%Y-%m-%d').date() if date_end else None
 
-    def get_csv_bits(self):
+    def get_csv_bits(self, csv_files=None):
         """Yield some rows from a csv file.
         """
-        with open(self.csv_filename, 'rb') as f:
-            reader = csv.DictReader(f)
-            try:
-                for row in reader:
-                    if self.keep_me(row):
-                        x = {k: row[k] for k in self.fieldnames_in}
-                        yield x
-            except csv.Error as e:
-                sys.exit('line %d: %s' % (reader.line_num, e))
+        for csv_filename in (csv_files or self.csv_files()):
+            with open(csv_filename, 'rb') as f:
+                reader = csv.DictReader(f)
+                try:
+                    for row in reader:
+                        if self.keep_me(row):
+                            x = {k: row[k] for k in self.fieldnames_in}
+                            yield x
+                except csv.Error as e:
+                    sys.exit('%s line %d: %s' % (csv_filename, reader.line_num, e))
+
+    def csv_files(self):
+        """The csv files to read.  Just the one, unless csv_filename is a
+        partitioned data set, then only the partitions with any Mining Date
+        in [mining_date_start, mining_date_end).
+        """
+        if not os.path.isdir(self.csv_filename):
+            return [self.csv_filename]
+        csv_files = list()
+        for partition in read_manifest(self.csv_filename):
+            if partition['Min Date'] is None:
+                # rows without a Mining Date are only wanted without a window
+                if self.mining_date_start or self.mining_date_end:
+                    continue
+            elif ((self.mining_date_start and
+                   partition['Max Date'] < self.mining_date_start) or
+                  (self.mining_date_end and
+                   partition['Min Date'] >= self.mining_date_end)):
+                continue
+            csv_files.append(os.path.join(self.csv_filename,
+                                          partition['Partition']))
+        log.debug('Reading %r of the partitions in %r', len(csv_files),
+                  self.csv_filename)
+        return csv_files
 
     def keep_me(self, row):
         """Keep this row?  Only in the date range, if given.
@@ -75,13 +123,35 @@ class GetDataSet(object):
             writer = csv.DictWriter(new_csv, self.fieldnames_out)
             # write the header row out first
             writer.writerow(dict(zip(self.fieldnames_out, self.fieldnames_out)))
-            self.save_list_of_dicts()
-            for row in self.list_of_dicts:
+            if self.max_keys:
+                # spilling, so the rows are not all kept in list_of_dicts
+                rows = self.get_rows()
+            else:
+                rows = self.save_list_of_dicts()
+            lines = 0
+            for row in rows:
                 writer.writerow(row)
-        return(len(self.list_of_dicts))
+                lines += 1
+        return(lines)
         # return the length of the new file
         # and then print that out with self.new_csv_name
 
+    def write_new_csv_sharded(self, max_rows=None, max_bytes=None, workers=4):
+        """Like write_new_csv, but into numbered shards of at most
+        max_rows rows or max_bytes bytes, written in parallel, with a
+        manifest.  See ShardedWriter.  Returns the manifest rows.
+        """
+        writer = ShardedWriter(
+            self.new_csv_name, self.fieldnames_out,
+            lambda f: csv.DictWriter(f, self.fieldnames_out),
+            max_rows, max_bytes, workers)
+        try:
+            writer.writerows(self.get_rows())
+            return writer.close()
+        finally:
+            # stop the pool's threads if reading or writing failed
+            writer.pool.terminate()
+
     def save_list_of_dicts(self):
         """Instead of writing out the new csv, maybe we need to save it as a
         list, for subsequent processing or whatever.
@@ -91,6 +161,344 @@ class GetDataSet(object):
             self.list_of_dicts.append(row)
         return self.list_of_dicts
 
+    def cache_params(self):
+        """Everything besides the input files that decides what the new
+        csv holds, for the ResultCache key.
+        """
+        return [self.__class__.__name__, str(self.mining_date_start),
+                str(self.mining_date_end)]
+
+
+class SpillingTotals(object):
+    """Add up Decimal totals by key, like a dict, but once there are
+    max_keys keys in memory hash partition them out to temporary csv files.
+    Keys are tuples of strings.  combine and parse can be changed to keep
+    something other than a sum, like the latest value seen for each key.
+
+    Reading the partitions back, a partition file with more than max_keys
+    rows is added up in another SpillingTotals, with a fan out worked out
+    from its size, which spills into smaller partitions again if it has to.
+    So no partition handed back has more than max_keys keys.
+
+    With max_keys of None nothing is ever spilled and the one partition is
+    just the dict in memory.
+    """
+    # give up splitting a partition that will not get any smaller
+    MAX_LEVEL = 8
+
+    def __init__(self, max_keys=None, partitions=16, combine=operator.add,
+                 parse=Decimal, level=0):
+        self.max_keys = max_keys
+        self.partitions = partitions
+        self.combine = combine
+        self.parse = parse
+        self.level = level
+        self.totals = dict()
+        self.spill_dir = None
+        self.partition_rows = dict()
+        self.spills = 0
+        self.peak_keys = 0
+
+    def add(self, key, amount):
+        if key in self.totals:
+            self.totals[key] = self.combine(self.totals[key], amount)
+            return
+        self.totals[key] = amount
+        self.peak_keys = max(self.peak_keys, len(self.totals))
+        if self.max_keys and len(self.totals) >= self.max_keys:
+            self.spill()
+
+    def partition_of(self, key):
+        # salted by level, so a partition split again spreads out
+        return hash('%d%r' % (self.level, key)) % self.partitions
+
+    def partition_name(self, i):
+        return os.path.join(self.spill_dir, 'part-%03d.csv' % i)
+
+    def spill(self):
+        """Append the totals in memory to their partition files and
+        start over with an empty dict.  A key may be spilled more than
+        once, the partition is added up again when it is read back.
+        """
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='mining_report-')
+        by_partition = dict()
+        for key, total in self.totals.iteritems():
+            by_partition.setdefault(self.partition_of(key), []).append(
+                list(key) + [str(total)])
+        for i, rows in by_partition.iteritems():
+            with open(self.partition_name(i), 'ab') as f:
+                csv.writer(f).writerows(rows)
+            self.partition_rows[i] = self.partition_rows.get(i, 0) + len(rows)
+        log.info('Spilled %r keys to %r', len(self.totals), self.spill_dir)
+        self.spills += 1
+        self.totals = dict()
+
+    def iter_partitions(self):
+        """Yield a dict of key: total for each partition.  Every key is
+        in exactly one of them, with its complete total.
+        """
+        if not self.spills:
+            yield self.totals
+            return
+        if self.totals:
+            self.spill()
+        log.info('Spilled %r times, at most %r keys in memory',
+                 self.spills, self.peak_keys)
+        try:
+            for i in sorted(self.partition_rows):
+                rows = self.partition_rows[i]
+                if rows > self.max_keys and self.level < self.MAX_LEVEL:
+                    partition = SpillingTotals(
+                        self.max_keys, rows // self.max_keys + 1,
+                        self.combine, self.parse, self.level + 1)
+                else:
+                    partition = SpillingTotals(
+                        None, combine=self.combine, parse=self.parse)
+                with open(self.partition_name(i), 'rb') as f:
+                    for row in csv.reader(f):
+                        partition.add(tuple(row[:-1]), self.parse(row[-1]))
+                for sub_partition in partition.iter_partitions():
+                    yield sub_partition
+        finally:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+
+def external_sort(rows, run_rows, types):
+    """Yield the tuples from rows in sorted order, holding at most run_rows
+    of them in memory: sorted runs go to temporary csv files and are merged
+    back together.  types turns each csv field back into its value, str
+    for strings.
+    """
+    chunk = list()
+    runs = list()
+    run_dir = None
+    try:
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= run_rows:
+                if run_dir is None:
+                    run_dir = tempfile.mkdtemp(prefix='mining_report-')
+                runs.append(write_run(run_dir, len(runs), chunk))
+                chunk = list()
+        if not runs:
+            chunk.sort()
+            for row in chunk:
+                yield row
+            return
+        runs.append(write_run(run_dir, len(runs), chunk))
+        chunk = None
+        for row in heapq.merge(*[read_run(run, types) for run in runs]):
+            yield row
+    finally:
+        if run_dir is not None:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def write_run(run_dir, i, chunk):
+    run = os.path.join(run_dir, 'run-%03d.csv' % i)
+    chunk.sort()
+    with open(run, 'wb') as f:
+        csv.writer(f).writerows(chunk)
+    return run
+
+
+def read_run(run, types):
+    with open(run, 'rb') as f:
+        for row in csv.reader(f):
+            yield tuple(t(v) for t, v in zip(types, row))
+
+
+MANIFEST_NAME = 'manifest.csv'
+MANIFEST_COLUMNS = ['Partition', 'Rows', 'Min Date', 'Max Date']
+
+
+def partition_by_month(csv_filename, partition_dir=None):
+    """Split the raw mining report into one csv per month of Mining Date,
+    in a directory named after the csv file, with a manifest.csv of the row
+    count and min/max Mining Date for each partition.  Rows without a valid
+    Mining Date go into undated.csv.  The directory can then be given
+    instead of the csv file, and only the months in the date window are read.
+    """
+    if partition_dir is None:
+        partition_dir = os.path.splitext(csv_filename)[0]
+    if not os.path.isdir(partition_dir):
+        os.makedirs(partition_dir)
+    partitions = dict()
+    with open(csv_filename, 'rb') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        date_column = header.index('Mining Date')
+        try:
+            for row in reader:
+                try:
+                    mining_date = datetime.strptime(row[date_column],
+                                                    '%Y-%m-%d').date()
+                    name = mining_date.strftime('%Y-%m.csv')
+                except (ValueError, IndexError):
+                    mining_date = None
+                    name = 'undated.csv'
+                if name not in partitions:
+                    new_csv = open(os.path.join(partition_dir, name), 'wb')
+                    writer = csv.writer(new_csv)
+                    writer.writerow(header)
+                    partitions[name] = {
+                        'file': new_csv, 'writer': writer, 'Partition': name,
+                        'Rows': 0, 'Min Date': None, 'Max Date': None}
+                partition = partitions[name]
+                partition['writer'].writerow(row)
+                partition['Rows'] += 1
+                if mining_date:
+                    if (partition['Min Date'] is None or
+                            mining_date < partition['Min Date']):
+                        partition['Min Date'] = mining_date
+                    if (partition['Max Date'] is None or
+                            mining_date > partition['Max Date']):
+                        partition['Max Date'] = mining_date
+        except csv.Error as e:
+            sys.exit('line %d: %s' % (reader.line_num, e))
+        finally:
+            for partition in partitions.itervalues():
+                partition['file'].close()
+    with open(os.path.join(partition_dir, MANIFEST_NAME), 'wb') as manifest:
+        writer = csv.DictWriter(manifest, MANIFEST_COLUMNS,
+                                extrasaction='ignore')
+        writer.writerow(dict(zip(MANIFEST_COLUMNS, MANIFEST_COLUMNS)))
+        for name in sorted(partitions):
+            writer.writerow(partitions[name])
+    return partition_dir, sorted(partitions)
+
+
+def read_manifest(partition_dir):
+    """Return the manifest of a partitioned data set as a list of dicts,
+    with the row counts as ints and the dates as dates (None if undated).
+    """
+    partitions = list()
+    with open(os.path.join(partition_dir, MANIFEST_NAME), 'rb') as f:
+        for row in csv.DictReader(f):
+            row['Rows'] = int(row['Rows'])
+            for c in ('Min Date', 'Max Date'):
+                row[c] = datetime.strptime(
+                    row[c], '%Y-%m-%d').date() if row[c] else None
+            partitions.append(row)
+    return partitions
+
+
+class ResultCache(object):
+    """Keep copies of the new csv files in cache_dir, keyed by the
+    fingerprints of the input csv (or partitioned data set) and of the Gem
+    Type lookup file, the data set class and its date window.  A rerun with
+    the same inputs copies the stored csv instead of working it all out
+    again.  The least recently used entries are removed once the cache is
+    over max_bytes.
+
+    Copies rather than hard links, since write_new_csv rewrites its file in
+    place and would change the cached copy along with it.
+    """
+    def __init__(self, cache_dir, max_bytes=100 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.fingerprints = dict()
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def fingerprint(self, path):
+        """sha1 of the contents of a file, or of every file in a
+        partitioned data set directory.
+        """
+        if path not in self.fingerprints:
+            if os.path.isdir(path):
+                paths = [os.path.join(path, name)
+                         for name in sorted(os.listdir(path))]
+            else:
+                paths = [path]
+            sha = hashlib.sha1()
+            for p in paths:
+                sha.update(os.path.basename(p) + '\0')
+                with open(p, 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), ''):
+                        sha.update(block)
+            self.fingerprints[path] = sha.hexdigest()
+        return self.fingerprints[path]
+
+    def entry_name(self, data_set):
+        key = [self.fingerprint(data_set.csv_filename),
+               self.fingerprint(GemTypeLookup.GEM_TYPE_LOOKUP_DATA)]
+        key += data_set.cache_params()
+        sha = hashlib.sha1('\0'.join(key)).hexdigest()
+        return os.path.join(self.cache_dir, sha + '.csv')
+
+    def fetch(self, data_set):
+        """Copy the cached csv to data_set.new_csv_name, if there is one.
+        """
+        entry = self.entry_name(data_set)
+        try:
+            shutil.copyfile(entry, data_set.new_csv_name)
+            # the mtime is the last use, for the LRU eviction
+            os.utime(entry, None)
+        except (IOError, OSError):
+            # not there, or another run evicted it, so work it out again
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def store(self, data_set):
+        """Copy data_set.new_csv_name into the cache.  The copy goes to a
+        temp file of its own first, so runs storing the same entry at once
+        never write over each other.
+        """
+        entry = self.entry_name(data_set)
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        os.close(fd)
+        try:
+            shutil.copyfile(data_set.new_csv_name, tmp)
+            os.rename(tmp, entry)
+        except:
+            os.remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits
+        in max_bytes.
+        """
+        entries = list()
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.csv'):
+                try:
+                    st = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    # another run evicted it already
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            log.info('Evicting %r from the cache', name)
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
+
+
+def peak_memory_kb():
+    """Peak resident memory of this process so far in KB, or None where
+    there is no resource module.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # the Mac reports bytes, not KB
+        peak //= 1024
+    return peak
+
 
 class SimpleSubset(GetDataSet):
     """Create a data set with a fixed subset of the columns from the
@@ -116,15 +524,19 @@ class TotalGoldRank(GetDataSet):
     Output file name suffix: -tgr
 
     """
-    def __init__(self, csv_filename, date_start, date_end):
+    def __init__(self, csv_filename, date_start, date_end, max_keys=None):
         super(TotalGoldRank, self).__init__(csv_filename, date_start,
-                                                      date_end)
+                                                      date_end, max_keys)
         self.fieldnames_in = ['Elf Name', 'Gold']
         # ambiguously, the title for the TGR column (for each row) works
         # fine also for the output column, TGR for each elf
         self.fieldnames_out = self.fieldnames_in + ['Rank']
         self.new_csv_name = os.path.splitext(self.csv_filename)[0] + '-tgr.csv'
-        self.get_rows = self.rank_tgr_by_elf
+        self.totals = None
+        if self.max_keys:
+            self.get_rows = self.spilled_rank_tgr_by_elf
+        else:
+            self.get_rows = self.rank_tgr_by_elf
 
     def rank_tgr_by_elf(self):
         """Rank the total gold for each elf.
@@ -144,6 +556,22 @@ class TotalGoldRank(GetDataSet):
         for total_row in rank:
             yield dict(zip(self.fieldnames_out, total_row))
 
+    def spilled_rank_tgr_by_elf(self):
+        """Same as rank_tgr_by_elf, but the totals are kept in a
+        SpillingTotals so they do not all have to fit in memory, and
+        external_sort puts them in order to hand out the ranks.  Ties are
+        ordered by Elf Name.
+        """
+        self.totals = SpillingTotals(self.max_keys)
+        for row in self.get_csv_bits():
+            self.totals.add((row['Elf Name'],), Decimal(row['Gold']))
+        by_total = external_sort(
+            ((-total, elf) for partition in self.totals.iter_partitions()
+             for (elf,), total in partition.iteritems()),
+            self.max_keys, [Decimal, str])
+        for i, (neg_total, elf) in enumerate(by_total):
+            yield dict(zip(self.fieldnames_out, (elf, -neg_total, i + 1)))
+
 """
         rank = sorted(totals.items(), key=lambda t: t[1], reverse=True)
 
@@ -205,15 +633,19 @@ class MarketShareAnalysis(GetDataSet):
     """Create a data set for the Total Weight by elf by
     Gem Color.
     """
-    def __init__(self, csv_filename, date_start, date_end):
+    def __init__(self, csv_filename, date_start, date_end, max_keys=None):
         super(MarketShareAnalysis, self).__init__(csv_filename, date_start,
-            date_end)
+            date_end, max_keys)
         self.new_csv_name = os.path.splitext(self.csv_filename)[0] + '-ms.csv'
         self.fieldnames_in = ['Elf Name', 'Elf ID', 'Gem Type', 'Weight', 'Quantity']
         self.fieldnames_out = ['Color Cat', 'Gem Color', 'Elf Name', 'Elf ID', 'Total Weight', 'Rank in Gem Color']
         self.gem_rows = self.lookup_gem_rows()
-        self.get_rows = self.elf_grams_by_gem_color
+        if self.max_keys:
+            self.get_rows = self.spilled_elf_grams_by_gem_color
+        else:
+            self.get_rows = self.elf_grams_by_gem_color
         self.elf_ids = None
+        self.totals = None
 
     def lookup_gem_rows(self):
         """Create a dict keyed by the Gem Type. This is not a get_rows
@@ -279,6 +711,13 @@ class MarketShareAnalysis(GetDataSet):
                     gem_colors[gem_color] = [(GemTypeLookup.COLOR_TO_COLORCAT[gem_color],
                        gem_color, elf, self.elf_ids[elf], total_grams)]
 
+        for row in self.rank_in_gem_colors(gem_colors):
+            yield row
+
+    def rank_in_gem_colors(self, gem_colors):
+        """Rank the elves within each Gem Color, given a dict of
+        gem_color: [(Color Cat, Gem Color, Elf Name, Elf ID, Total Weight)].
+        """
         for gem_color, elf_grams in gem_colors.iteritems():
             rank = sorted(elf_grams, key=lambda t: t[4], reverse=True)
             rank = [rank[i] + (i+1,) for i in range(len(rank))]
@@ -286,6 +725,54 @@ class MarketShareAnalysis(GetDataSet):
                 # self.fieldnames_out = ['Color Cat', 'Gem Color', 'Elf Name', 'Elf ID', 'Total Weight', 'Rank in Gem Color']
                 yield dict(zip(self.fieldnames_out, row))
 
+    def spilled_elf_grams_by_gem_color(self):
+        """Same as elf_grams_by_gem_color, but nothing grows with the
+        number of elves.  The (Gem Color, Elf Name) totals, and the latest
+        Elf ID for each elf, are kept in SpillingTotals.  The totals are put
+        in order by Gem Color and Total Weight to hand out the ranks, then
+        in order by Elf Name to be joined up with the Elf IDs.  Ties are
+        ordered by Elf Name, and the rows come out by Elf Name.
+        """
+        self.totals = SpillingTotals(self.max_keys)
+        elf_ids = SpillingTotals(self.max_keys, combine=lambda old, new: new,
+                                 parse=str)
+        for row in self.get_csv_bits():
+            elf = row['Elf Name']
+            elf_ids.add((elf,), row['Elf ID'])
+            gem_color = self.gem_rows[row['Gem Type']]
+            self.totals.add((gem_color, elf),
+                            Decimal(row['Weight']) * Decimal(row['Quantity']))
+        by_color = external_sort(
+            ((gem_color, -total_grams, elf)
+             for partition in self.totals.iter_partitions()
+             for (gem_color, elf), total_grams in partition.iteritems()),
+            self.max_keys, [str, Decimal, str])
+        by_elf = external_sort(self.rank_sorted_gem_colors(by_color),
+                               self.max_keys, [str, str, Decimal, int])
+        ids = external_sort(
+            ((elf, elf_id) for partition in elf_ids.iter_partitions()
+             for (elf,), elf_id in partition.iteritems()),
+            self.max_keys, [str, str])
+        id_elf = None
+        for elf, gem_color, total_grams, rank in by_elf:
+            while id_elf != elf:
+                id_elf, elf_id = next(ids)
+            row = (GemTypeLookup.COLOR_TO_COLORCAT[gem_color], gem_color,
+                   elf, elf_id, total_grams, rank)
+            yield dict(zip(self.fieldnames_out, row))
+
+    def rank_sorted_gem_colors(self, by_color):
+        """Yield (Elf Name, Gem Color, Total Weight, Rank in Gem Color)
+        from (Gem Color, -Total Weight, Elf Name) in sorted order.
+        """
+        gem_color = None
+        for color, neg_total_grams, elf in by_color:
+            if color != gem_color:
+                gem_color = color
+                rank = 0
+            rank += 1
+            yield elf, gem_color, -neg_total_grams, rank
+
 
 class AllColorTotals(MarketShareAnalysis):
     """Create a data set for the Total Weight by
@@ -315,15 +802,216 @@ class AllColorTotals(MarketShareAnalysis):
             yield dict(zip(self.fieldnames_out, row))
 
 
+class TrailingWindow(object):
+    """The running total and the trailing window_days sum of one measure
+    for one key, fed one day at a time in date order.  The deque holds at
+    most one (day, amount) per day in the window.
+    """
+    AVERAGE_PLACES = Decimal('0.001')
+
+    def __init__(self, window_days):
+        if window_days < 1:
+            raise ValueError('window_days must be at least 1, not %r'
+                             % window_days)
+        self.window_days = window_days
+        self.running = Decimal(0)
+        self.trailing = Decimal(0)
+        self.window = collections.deque(maxlen=window_days)
+
+    def add(self, day, amount):
+        # expire first, so the full deque never drops a day on its own
+        while (self.window and
+               (day - self.window[0][0]).days >= self.window_days):
+            self.trailing -= self.window.popleft()[1]
+        self.window.append((day, amount))
+        self.running += amount
+        self.trailing += amount
+
+    def average(self):
+        """Average per day over the trailing window, to the thousandth.
+        """
+        return (self.trailing / self.window_days).quantize(
+            self.AVERAGE_PLACES, ROUND_HALF_UP)
+
+
+class RunningTotals(MarketShareAnalysis):
+    """Create a data set with running totals, trailing window sums and
+    averages, and rank over time, so Tableau only has to show them instead
+    of working them out with table calculations on the raw extract.
+    Output file name suffix: -ts
+
+    For each Mining Date, each elf that mined that day gets a row with Gem
+    Color 'All', its Gold and Weight, and Rank by Running Gold among all the
+    elves so far; and a row for each Gem Color it mined that day, with the
+    Weight and Rank by Running Weight within that Gem Color.  The trailing
+    sums and averages cover window_days days up to and including the date.
+    """
+    ALL_COLORS = 'All'
+
+    def __init__(self, csv_filename, date_start, date_end, window_days=30,
+                 sort_rows=100000, presorted=False):
+        super(RunningTotals, self).__init__(csv_filename, date_start,
+                                            date_end)
+        if window_days < 1:
+            raise ValueError('window_days must be at least 1, not %r'
+                             % window_days)
+        self.new_csv_name = os.path.splitext(self.csv_filename)[0] + '-ts.csv'
+        self.fieldnames_in = ['Elf Name', 'Mining Date', 'Gem Type', 'Weight',
+                              'Quantity', 'Gold']
+        self.fieldnames_out = [
+            'Mining Date',
+            'Elf Name',
+            'Gem Color',
+            'Gold',
+            'Running Gold',
+            'Trailing Gold',
+            'Trailing Average Gold',
+            'Weight',
+            'Running Weight',
+            'Trailing Weight',
+            'Trailing Average Weight',
+            'Rank',
+            ]
+        self.window_days = window_days
+        # rows per sorted run when the input has to be sorted first
+        self.sort_rows = sort_rows
+        # the caller says the input is in Mining Date order, see
+        # date_ordered_rows
+        self.presorted = presorted
+        self.get_rows = self.running_totals
+
+    def cache_params(self):
+        return (super(RunningTotals, self).cache_params() +
+                [str(self.window_days)])
+
+    def running_totals(self):
+        """Add up each day in one pass over the date ordered rows, and
+        when the date changes, slide the windows and yield that day's rows.
+        """
+        gold = dict()
+        weight = dict()
+        # the weight keys for each Gem Color, to rank within it
+        color_keys = dict()
+        day = None
+        for row in self.date_ordered_rows():
+            mining_date = datetime.strptime(row['Mining Date'],
+                                            '%Y-%m-%d').date()
+            if mining_date != day:
+                if day is not None and mining_date < day:
+                    # only presorted input can go backwards
+                    sys.exit('%s is not in Mining Date order, %s comes after '
+                             '%s; run without --sorted to sort it' % (
+                                 self.csv_filename, mining_date, day))
+                if day is not None:
+                    for out_row in self.close_day(day, day_gold, day_weight,
+                                                  gold, weight, color_keys):
+                        yield out_row
+                day = mining_date
+                day_gold = dict()
+                day_weight = dict()
+            elf = row['Elf Name']
+            gem_color = self.gem_rows[row['Gem Type']]
+            grams = Decimal(row['Weight']) * Decimal(row['Quantity'])
+            day_gold[elf] = day_gold.get(elf, 0) + Decimal(row['Gold'])
+            for key in ((elf, self.ALL_COLORS), (elf, gem_color)):
+                day_weight[key] = day_weight.get(key, 0) + grams
+        if day is not None:
+            for out_row in self.close_day(day, day_gold, day_weight,
+                                          gold, weight, color_keys):
+                yield out_row
+
+    def close_day(self, day, day_gold, day_weight, gold, weight, color_keys):
+        """Feed one day's totals to the windows and yield the rows for
+        every elf and Gem Color with any mining that day.
+        """
+        for elf, amount in day_gold.iteritems():
+            if elf not in gold:
+                gold[elf] = TrailingWindow(self.window_days)
+            gold[elf].add(day, amount)
+        for key, amount in day_weight.iteritems():
+            if key not in weight:
+                weight[key] = TrailingWindow(self.window_days)
+                color_keys.setdefault(key[1], set()).add(key)
+            weight[key].add(day, amount)
+
+        ranks = dict()
+        rank = sorted(gold, key=lambda elf: gold[elf].running, reverse=True)
+        for i, elf in enumerate(rank):
+            ranks[elf, self.ALL_COLORS] = i + 1
+        day_colors = set(gem_color for elf, gem_color in day_weight)
+        day_colors.discard(self.ALL_COLORS)
+        for gem_color in day_colors:
+            rank = sorted(color_keys[gem_color],
+                          key=lambda key: weight[key].running, reverse=True)
+            for i, key in enumerate(rank):
+                ranks[key] = i + 1
+
+        mining_date = day.isoformat()
+        for elf, gem_color in sorted(day_weight):
+            w = weight[elf, gem_color]
+            row = {
+                'Mining Date': mining_date,
+                'Elf Name': elf,
+                'Gem Color': gem_color,
+                'Weight': day_weight[elf, gem_color],
+                'Running Weight': w.running,
+                'Trailing Weight': w.trailing,
+                'Trailing Average Weight': w.average(),
+                'Rank': ranks[elf, gem_color],
+            }
+            if gem_color == self.ALL_COLORS:
+                g = gold[elf]
+                row['Gold'] = day_gold[elf]
+                row['Running Gold'] = g.running
+                row['Trailing Gold'] = g.trailing
+                row['Trailing Average Gold'] = g.average()
+            yield row
+
+    def date_ordered_rows(self):
+        """Yield the rows in Mining Date order.  With presorted the input is
+        taken to be in order already and streamed as it is, in one pass;
+        running_totals stops at the first Mining Date that goes backwards.
+        Otherwise a partitioned data set, whose months are in order, has each
+        partition sorted on its own as it is read, and a single csv is sorted
+        whole.  The sort is external_sort, with at most sort_rows rows in
+        memory.
+        """
+        if self.presorted:
+            for row in self.get_csv_bits():
+                yield row
+        elif os.path.isdir(self.csv_filename):
+            for csv_filename in self.csv_files():
+                for row in self.sorted_rows(self.get_csv_bits([csv_filename])):
+                    yield row
+        else:
+            for row in self.sorted_rows(self.get_csv_bits()):
+                yield row
+
+    def sorted_rows(self, rows):
+        """Sort rows by Mining Date, keeping rows of the same date in the
+        order they came in.
+        """
+        def keyed_rows():
+            for i, row in enumerate(rows):
+                mining_date = datetime.strptime(row['Mining Date'],
+                                                '%Y-%m-%d').date()
+                # the row number keeps the sort stable
+                yield ((mining_date.isoformat(), i) +
+                       tuple(row[k] for k in self.fieldnames_in))
+        types = [str, int] + [str] * len(self.fieldnames_in)
+        for row in external_sort(keyed_rows(), self.sort_rows, types):
+            yield dict(zip(self.fieldnames_in, row[2:]))
+
 
 class MarketShareAnalysisMatrix(GetDataSet):
     """Create a combo dataset for everything needed in the
     MarketShare Analysis report.
     """
-    def __init__(self, csv_filename, date_start, date_end):
+    def __init__(self, csv_filename, date_start, date_end, max_keys=None):
         super(MarketShareAnalysisMatrix, self).__init__(csv_filename,
                                                           date_start,
-                                                          date_end)
+                                                          date_end,
+                                                          max_keys)
         self.fieldnames_out = [
             'Elf Name',
             'Elf ID',
@@ -340,7 +1028,10 @@ class MarketShareAnalysisMatrix(GetDataSet):
         self.date_start = date_start
         self.date_end = date_end
         self.new_csv_name = os.path.splitext(self.csv_filename)[0] + '-ms.csv'
-        self.get_rows = self.calculate_MarketShare_matrix
+        if self.max_keys:
+            self.get_rows = self.spilled_MarketShare_matrix
+        else:
+            self.get_rows = self.calculate_MarketShare_matrix
 
     def double_key_elf_color(self, list_of_dicts):
         """Make a double index dict where the key is the tuple (elf,colorcat)
@@ -356,92 +1047,288 @@ class MarketShareAnalysisMatrix(GetDataSet):
         the full matrix.
 
         """
-        data_2014 = MarketShareAnalysis(self.csv_filename, '2014-1-1', '2015-1-1')
+        data_2014 = MarketShareAnalysis(self.csv_filename, '2014-1-1', '2015-1-1',
+                                        self.max_keys)
         elfncolor_2014 = self.double_key_elf_color(data_2014.save_list_of_dicts())
         # ['Color Cat', 'Gem Color', 'Elf Name', 'Total Weight', 'Rank in Gem Color']
         data_2015 = MarketShareAnalysis(self.csv_filename,
-                                      self.date_start, self.date_end)
+                                      self.date_start, self.date_end,
+                                      self.max_keys)
         elfncolor_2015 = self.double_key_elf_color(data_2015.save_list_of_dicts())
         gem_rows = data_2015.get_gem_rows()
         data_2015_all = AllColorTotals(self.csv_filename,
                                          self.date_start, self.date_end)
         data_2015_all.save_list_of_dicts()
         # we are reporting on 2015, so use that for the list of elves
-        # better to save the list of elves in the other class than this silliness
-        elves = data_2015.elf_ids.keys()
+        elf_ids = dict()
+        for (elf, color), enc in elfncolor_2015.iteritems():
+            elf_ids[elf] = enc['Elf ID']
+        elves = elf_ids.keys()
         # gem_rows has the complete set of colors
         colors = list(set(gem_rows.values()))
-        import itertools
         elves_and_colors = [element for element in itertools.product(elves, colors)]
         for elfncolor in elves_and_colors:
             elf = elfncolor[0]
             color = elfncolor[1]
-            try:
-                row = {
-                    'Elf Name': elf,
-                    'Color Cat': GemTypeLookup.COLOR_TO_COLORCAT[color],
-                    'Gem Color': color,
-                    'Elf ID': data_2015.elf_ids[elf],
-                }
-            except KeyError:
-                log.info("Skipping unknown color %r", color)
-                continue
-            try:
-                enc_2014 = elfncolor_2014[elfncolor]
-            except KeyError:
-                enc_2014 = None
-            if enc_2014:
-                row['Total Weight 2014'] = enc_2014['Total Weight']
-            else:
-                row['Total Weight 2014'] = None
-            try:
-                enc_2015 = elfncolor_2015[elfncolor]
-            except KeyError:
-                enc_2015 = None
-            prev_year = None
-            if enc_2015:
-                row['Total Weight 2015'] = enc_2015['Total Weight']
-                row['2015 Color Rank'] = enc_2015['Rank in Gem Color']
-                if row['Total Weight 2014']:
-                    prev_year = (Decimal(row['Total Weight 2015']) /
-                                 Decimal(row['Total Weight 2014']))
+            row = self.matrix_row(elf, elf_ids[elf], color,
+                                  elfncolor_2014.get(elfncolor),
+                                  elfncolor_2015.get(elfncolor),
+                                  data_2015_all.totals_by_color)
+            if row:
+                yield row
+
+    def spilled_MarketShare_matrix(self):
+        """Same as calculate_MarketShare_matrix, but nothing is kept for
+        every elf.  The spilled MarketShareAnalysis rows come out of
+        external_sort in order by (Elf Name, Gem Color), so 2014 is merge
+        joined to 2015 on that key, and each 2015 elf gets its row for every
+        Gem Color as it goes by.  The rows come out by Elf Name and Gem Color.
+        """
+        data_2014 = MarketShareAnalysis(self.csv_filename, '2014-1-1',
+                                        '2015-1-1', self.max_keys)
+        data_2015 = MarketShareAnalysis(self.csv_filename,
+                                        self.date_start, self.date_end,
+                                        self.max_keys)
+        data_2015_all = AllColorTotals(self.csv_filename,
+                                       self.date_start, self.date_end)
+        # only one row per Gem Color, for totals_by_color
+        for row in data_2015_all.get_rows():
+            pass
+        colors = sorted(set(data_2015.get_gem_rows().values()))
+        rows_2014 = data_2014.get_rows()
+        enc_2014 = next(rows_2014, None)
+        for elf, encs_2015 in itertools.groupby(
+                data_2015.get_rows(), operator.itemgetter('Elf Name')):
+            # at most one row for each Gem Color of this elf
+            encs_2015 = dict((enc['Gem Color'], enc) for enc in encs_2015)
+            elf_id = next(encs_2015.itervalues())['Elf ID']
+            for color in colors:
+                while (enc_2014 and
+                       (enc_2014['Elf Name'], enc_2014['Gem Color']) <
+                       (elf, color)):
+                    enc_2014 = next(rows_2014, None)
+                if (enc_2014 and
+                        (enc_2014['Elf Name'], enc_2014['Gem Color']) ==
+                        (elf, color)):
+                    elfncolor_2014 = enc_2014
+                else:
+                    elfncolor_2014 = None
+                row = self.matrix_row(elf, elf_id, color, elfncolor_2014,
+                                      encs_2015.get(color),
+                                      data_2015_all.totals_by_color)
+                if row:
+                    yield row
+
+    def matrix_row(self, elf, elf_id, color, enc_2014, enc_2015,
+                   totals_by_color):
+        """The matrix row for one elf and Gem Color, given its
+        MarketShareAnalysis rows for 2014 and 2015 (None if it has none),
+        or None for a color with no Color Cat.
+        """
+        try:
+            row = {
+                'Elf Name': elf,
+                'Color Cat': GemTypeLookup.COLOR_TO_COLORCAT[color],
+                'Gem Color': color,
+                'Elf ID': elf_id,
+            }
+        except KeyError:
+            log.info("Skipping unknown color %r", color)
+            return None
+        if enc_2014:
+            row['Total Weight 2014'] = enc_2014['Total Weight']
+        else:
+            row['Total Weight 2014'] = None
+        prev_year = None
+        if enc_2015:
+            row['Total Weight 2015'] = enc_2015['Total Weight']
+            row['2015 Color Rank'] = enc_2015['Rank in Gem Color']
+            if row['Total Weight 2014']:
+                prev_year = (Decimal(row['Total Weight 2015']) /
+                             Decimal(row['Total Weight 2014']))
+        else:
+            row['Total Weight 2015'] = None
+            row['2015 Color Rank'] = None
+        row['2015 vs. 2014'] = prev_year
+        # get the total in this Gem Color for 2015 so far, if any
+        try:
+            total_2015 = totals_by_color[color]
+        except KeyError:
+            total_2015 = None
+        if total_2015 and row['Total Weight 2015']:
+            row['2015 Mining Market Share'] = (row['Total Weight 2015'] / total_2015)
+        else:
+            row['2015 Mining Market Share'] = None
+        return row
+
+
+# the new csv files, by the suffix on the names the workbook uses
+WORKBOOK_SUFFIXES = ['-tgr.csv', '-ms.csv', '-ts.csv']
+
+
+def refresh_workbook(twbx_filename, csv_filename, new_csv_files,
+                     twbx_out=None):
+    """Put the raw csv and the new csv files made from it into a copy of
+    the packaged workbook, under the names its text file connections already
+    use, so there is no Replace Data Source to do by hand.  Only the files
+    in new_csv_files, the ones written by this run, go in; the raw csv
+    replaces the connection named like the -tgr and -ms ones without the
+    suffix.  The workbook (.twb) is only read, never changed, and the other
+    members are copied across as they are.  With no twbx_out the
+    workbook is refreshed in place.  Returns a dict of member: csv file put
+    in.
+
+    Tableau still has to refresh its extracts (.tde) from the new csv files,
+    this cannot write them.
+    """
+    if twbx_out is None:
+        twbx_out = twbx_filename
+    base_name = os.path.splitext(os.path.normpath(csv_filename))[0]
+    new_csv_files = set(os.path.normpath(name) for name in new_csv_files)
+    replacements = dict()
+    with zipfile.ZipFile(twbx_filename) as twbx:
+        twb = [name for name in twbx.namelist() if name.endswith('.twb')][0]
+        connections = list(workbook_text_files(twbx.open(twb)))
+        # the raw csv, as named by the workbook, e.g. 2015y-elf.csv
+        raw_names = set()
+        for directory, filename in connections:
+            for suffix in WORKBOOK_SUFFIXES:
+                if filename.endswith(suffix):
+                    raw_names.add(filename[:-len(suffix)] + '.csv')
+        for directory, filename in connections:
+            member = packaged_name(directory, filename)
+            for suffix in WORKBOOK_SUFFIXES:
+                if filename.endswith(suffix):
+                    new_csv_name = base_name + suffix
+                    if new_csv_name in new_csv_files:
+                        replacements[member] = new_csv_name
+                    else:
+                        log.info('No %r from this run for %r, leaving it',
+                                 new_csv_name, member)
+                    break
             else:
-                row['Total Weight 2015'] = None
-                row['2015 Color Rank'] = None
-            row['2015 vs. 2014'] = prev_year
-            # get the total in this Gem Color for 2015 so far, if any
-            try:
-                total_2015 = data_2015_all.totals_by_color[color]
-            except KeyError:
-                total_2015 = None
-            if total_2015 and row['Total Weight 2015']:
-                row['2015 Mining Market Share'] = (row['Total Weight 2015'] / total_2015)
+                if filename not in raw_names:
+                    log.info('Leaving %r, it is not one of ours', member)
+                elif os.path.isfile(csv_filename):
+                    replacements[member] = csv_filename
+                else:
+                    log.info('No raw csv file for %r, leaving it', member)
+        fd, tmp = tempfile.mkstemp(suffix='.twbx',
+                                   dir=os.path.dirname(os.path.abspath(twbx_out)))
+        os.close(fd)
+        try:
+            if not set(twbx.namelist()) & set(replacements):
+                # nothing to replace, so add to a copy of the original
+                shutil.copyfile(twbx_filename, tmp)
+                with zipfile.ZipFile(tmp, 'a', zipfile.ZIP_DEFLATED,
+                                     allowZip64=True) as new_twbx:
+                    for member in sorted(replacements):
+                        new_twbx.write(replacements[member], member)
             else:
-                row['2015 Mining Market Share'] = None
-            yield row
+                with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED,
+                                     allowZip64=True) as new_twbx:
+                    for info in twbx.infolist():
+                        if info.filename not in replacements:
+                            copy_member(twbx, new_twbx, info)
+                    for member in sorted(replacements):
+                        new_twbx.write(replacements[member], member)
+        except:
+            os.remove(tmp)
+            raise
+    os.rename(tmp, twbx_out)
+    return replacements
 
 
-def make_rank_by_tgr(csv_filename, start_date, end_date):
-    """Get the rank by total gold dataset.
+def workbook_text_files(twb):
+    """Yield (directory, filename) for each text file connection in the
+    workbook xml.
+    """
+    for event, element in cElementTree.iterparse(twb):
+        if (element.tag == 'connection' and
+                element.get('class') == 'textscan'):
+            yield element.get('directory'), element.get('filename')
+
+
+def packaged_name(directory, filename):
+    """Where a text file goes inside the twbx.  Tableau records the
+    directory it unpacked the workbook into, ending in Data/<folder>.
+    """
+    directory = directory.replace('\\', '/')
+    if '/Data/' in directory:
+        folder = directory[directory.rindex('/Data/') + 1:]
+    else:
+        folder = 'Data/' + os.path.basename(directory)
+    return folder + '/' + filename
+
+
+def copy_member(twbx, new_twbx, info):
+    """Copy one member of a zip file into another, keeping its ZipInfo
+    (date, compression, permissions in external_attr and so on).  The
+    members copied are the .twb and the extracts, small enough to read whole.
     """
-    data_set = TotalGoldRank(csv_filename, start_date, end_date)
+    # a copy, since writestr fills in the sizes and offset of the new one
+    new_twbx.writestr(copy.copy(info), twbx.read(info))
+
+
+def write_data_set(data_set, cache=None, shard_rows=None, shard_bytes=None):
+    """Write out the new csv for a data set, or copy it from the cache.
+    Sharded output skips the cache.  Returns the new csv file name, or None
+    for sharded output.
+    """
+    if shard_rows or shard_bytes:
+        manifest = data_set.write_new_csv_sharded(shard_rows, shard_bytes)
+        for shard in manifest:
+            print "wrote %r lines to %r" % (shard['Rows'], shard['Shard'])
+        return None
+    if cache and cache.fetch(data_set):
+        print "copied %r from the cache" % data_set.new_csv_name
+        return data_set.new_csv_name
     lines = data_set.write_new_csv()
     print "wrote %r lines to %r" % (lines, data_set.new_csv_name)
+    if cache:
+        cache.store(data_set)
+    return data_set.new_csv_name
+
+
+def make_rank_by_tgr(csv_filename, start_date, end_date, max_keys=None,
+                     cache=None, shard_rows=None, shard_bytes=None):
+    """Get the rank by total gold dataset.
+    """
+    data_set = TotalGoldRank(csv_filename, start_date, end_date, max_keys)
+    new_csv_name = write_data_set(data_set, cache, shard_rows, shard_bytes)
+    if max_keys and resource is not None:
+        print "peak memory %r KB" % peak_memory_kb()
+    return new_csv_name
 
 
 
-def make_market_share_data(csv_filename, start_date, end_date):
+def make_market_share_data(csv_filename, start_date, end_date,
+                           max_keys=None, cache=None, shard_rows=None,
+                           shard_bytes=None):
     """Put all of Market Share columns into a single csv.
     """
-    data_set = MarketShareAnalysisMatrix(csv_filename, start_date, end_date)
-    lines = data_set.write_new_csv()
-    print "wrote %r lines to %r" % (lines, data_set.new_csv_name)
+    data_set = MarketShareAnalysisMatrix(csv_filename, start_date, end_date,
+                                         max_keys)
+    new_csv_name = write_data_set(data_set, cache, shard_rows, shard_bytes)
+    if max_keys and resource is not None:
+        print "peak memory %r KB" % peak_memory_kb()
+    return new_csv_name
+
+def make_running_totals(csv_filename, start_date, end_date, window_days,
+                        cache=None, shard_rows=None, shard_bytes=None,
+                        presorted=False):
+    """Get the running totals and trailing window dataset.
+    """
+    data_set = RunningTotals(csv_filename, start_date, end_date, window_days,
+                             presorted=presorted)
+    return write_data_set(data_set, cache, shard_rows, shard_bytes)
 
 def show_notes():
     """Show notes about creating data sets to use in Tableau.
     """
     print "TotalGoldRank: ", TotalGoldRank.__doc__
     print "MarketShareAnalysis: ", MarketShareAnalysis.__doc__
+    print "RunningTotals: ", RunningTotals.__doc__
     print """
 
 Fixups:
@@ -478,11 +1365,25 @@ gem type lookup file colo.csv), AllColorTotals.
 
 Joins and data blends as alternatives to this code have different drawbacks.
 
+Partitioned data sets
+---------------------
+
+Run with -p to split the raw csv into one csv per month in a directory of the
+same name, with a manifest.csv of the rows and min/max Mining Date in each.
+Give the directory instead of the csv file and only the months that overlap
+the date window are read (the 2014 comparison only reads 2014).  The output
+files are named after the directory just as they would be after the csv.
+
 Instructions
 ------------
 
-Run this script, open the twbx file in Tableau desktop, open the three data
-sources (the original csv and the two generated by this script, not colo.csv
+Run this script with -k and the twbx file, and the raw csv and the new -tgr
+and -ms csv files are put into the workbook under the names it already uses
+(use --workbook_out to leave the original alone, say for another region).
+Then open it in Tableau desktop and refresh the extracts.
+
+Or, without -k, run this script, open the twbx file in Tableau desktop, open
+the three data sources (the original csv and the two generated by this script, not colo.csv
 which is just used by the script, not used by Tableau) and use Replace Data
 Source to replace each of the old sources with your new ones. Close the old
 ones, just to avoid confusion.
@@ -522,7 +1423,84 @@ def main():
         default=DATE_END,
         help='Exclusive date mining end date.',
     )
+    parser.add_option(
+        '-p',
+        '--partition',
+        action='store_true',
+        dest='partition',
+        help='Split the csv file into month partitions and exit.',
+    )
+    parser.add_option(
+        '-t',
+        '--time_series',
+        action='store_true',
+        dest='time_series',
+        help='Also write the running totals and trailing windows (-ts).',
+    )
+    parser.add_option(
+        '-w',
+        '--window_days',
+        type='int',
+        default=30,
+        help='Days in the trailing window for -t, default 30.',
+    )
+    parser.add_option(
+        '--sorted',
+        action='store_true',
+        dest='presorted',
+        help='The csv is already in Mining Date order, so -t reads it once '
+             'without sorting it (and stops if it is not).',
+    )
+    parser.add_option(
+        '-c',
+        '--cache_dir',
+        default=None,
+        help='Reuse the new csv files kept here from runs with the same input.',
+    )
+    parser.add_option(
+        '--cache_mb',
+        type='int',
+        default=100,
+        help='Size of the --cache_dir cache in MB, default 100.',
+    )
+    parser.add_option(
+        '-r',
+        '--shard_rows',
+        type='int',
+        default=None,
+        help='Split each new csv into files of at most this many rows.',
+    )
+    parser.add_option(
+        '-b',
+        '--shard_mb',
+        type='float',
+        default=None,
+        help='Split each new csv into files of at most this many MB.',
+    )
+    parser.add_option(
+        '-k',
+        '--workbook',
+        default=None,
+        help='Put the new csv files into this packaged workbook (.twbx).',
+    )
+    parser.add_option(
+        '--workbook_out',
+        default=None,
+        help='Write the -k workbook here instead of in place.',
+    )
+    parser.add_option(
+        '-m',
+        '--max_keys',
+        type='int',
+        default=None,
+        help='Spill the totals to temporary files past this many keys in memory.',
+    )
     (opts, args) = parser.parse_args()
+    if opts.window_days < 1:
+        parser.error('--window_days must be at least 1')
+    if opts.workbook and (opts.shard_rows or opts.shard_mb):
+        parser.error('--workbook needs whole csv files, not --shard_rows '
+                     'or --shard_mb')
     if opts.note:
         show_notes()
         print parser.format_help()
@@ -533,8 +1511,36 @@ def main():
         exit()
         # raise optparse.BadOptionError('CSV file name required.')
 
-    make_rank_by_tgr(args[0], opts.start_date, opts.end_date)
-    make_market_share_data(args[0], opts.start_date, opts.end_date)
+    if opts.partition:
+        partition_dir, partitions = partition_by_month(args[0])
+        print "wrote %r partitions to %r" % (len(partitions), partition_dir)
+        exit()
+
+    cache = None
+    if opts.cache_dir:
+        cache = ResultCache(opts.cache_dir, opts.cache_mb * 1024 * 1024)
+
+    shard_bytes = int(opts.shard_mb * 1024 * 1024) if opts.shard_mb else None
+    new_csv_files = list()
+    new_csv_files.append(make_rank_by_tgr(
+        args[0], opts.start_date, opts.end_date, opts.max_keys, cache,
+        opts.shard_rows, shard_bytes))
+    new_csv_files.append(make_market_share_data(
+        args[0], opts.start_date, opts.end_date, opts.max_keys, cache,
+        opts.shard_rows, shard_bytes))
+    if opts.time_series:
+        new_csv_files.append(make_running_totals(
+            args[0], opts.start_date, opts.end_date, opts.window_days, cache,
+            opts.shard_rows, shard_bytes, opts.presorted))
+    if cache:
+        print "cache: %r hits, %r misses" % (cache.hits, cache.misses)
+    if opts.workbook:
+        twbx_out = opts.workbook_out or opts.workbook
+        replacements = refresh_workbook(opts.workbook, args[0],
+                                        new_csv_files, twbx_out)
+        for member in sorted(replacements):
+            print "put %r into %r as %r" % (replacements[member], twbx_out,
+                                            member)
 
 
 if __name__ == '__main__':
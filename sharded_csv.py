@@ -0,0 +1,116 @@
+"""
+Write a csv out as numbered shards, each capped by a number of rows or
+bytes, with a manifest of the rows, bytes and sha1 checksum of each shard.
+Shards are written to disk by a pool of threads while the next one is
+being filled.
+
+Used by mining_report.py and translate_to_NPSP.py for output too big for
+one file, like the row limit of the Salesforce Data Import Wizard.
+"""
+import os
+import csv
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+import logging
+log = logging.getLogger(__name__)
+
+
+MANIFEST_COLUMNS = ['Shard', 'Rows', 'Bytes', 'SHA1']
+
+
+class LastLine(object):
+    """Stands in for a file, for a csv writer to format one row at a time.
+    """
+    def __init__(self):
+        self.line = None
+
+    def write(self, line):
+        self.line = line
+
+
+class ShardedWriter(object):
+    """Write rows like a csv writer, but into new_csv_name-001.csv,
+    new_csv_name-002.csv and so on, each with the header row, at most
+    max_rows rows (not counting the header) and at most max_bytes bytes.
+    A shard always gets at least one row, even if that row is bigger than
+    max_bytes.  make_writer turns a file into a csv.writer or DictWriter
+    for the rows.  close writes the new_csv_name-manifest.csv.
+    """
+    def __init__(self, new_csv_name, fieldnames, make_writer=csv.writer,
+                 max_rows=None, max_bytes=None, workers=4):
+        self.base_name = os.path.splitext(new_csv_name)[0]
+        self.manifest_name = self.base_name + '-manifest.csv'
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.last_line = LastLine()
+        csv.writer(self.last_line).writerow(fieldnames)
+        self.header = self.last_line.line
+        self.writer = make_writer(self.last_line)
+        self.lines = list()
+        self.shard_bytes = 0
+        self.shards = list()
+        self.pool = ThreadPool(workers)
+        # at most this many shards in memory, waiting to be written
+        self.in_flight = threading.BoundedSemaphore(workers + 1)
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        line = self.last_line.line
+        if self.lines and (
+                (self.max_rows and len(self.lines) >= self.max_rows) or
+                (self.max_bytes and
+                 self.shard_bytes + len(line) > self.max_bytes)):
+            self.seal()
+        if not self.lines:
+            self.shard_bytes = len(self.header)
+        self.lines.append(line)
+        self.shard_bytes += len(line)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def seal(self):
+        """Hand the shard being filled to the pool, and start a new one.
+        """
+        name = '%s-%03d.csv' % (self.base_name, len(self.shards) + 1)
+        self.in_flight.acquire()
+        self.shards.append(self.pool.apply_async(
+            write_shard, (name, self.header, self.lines, self.in_flight)))
+        self.lines = list()
+        self.shard_bytes = 0
+
+    def close(self):
+        """Write out the last shard, wait for them all, and write the
+        manifest.  Returns the manifest rows, one dict per shard.
+        """
+        if self.lines or not self.shards:
+            self.seal()
+        self.pool.close()
+        self.pool.join()
+        # get() raises any error from writing a shard
+        manifest = [shard.get() for shard in self.shards]
+        with open(self.manifest_name, 'wb') as f:
+            writer = csv.DictWriter(f, MANIFEST_COLUMNS)
+            writer.writerow(dict(zip(MANIFEST_COLUMNS, MANIFEST_COLUMNS)))
+            writer.writerows(manifest)
+        log.info('Wrote %r shards, see %r', len(manifest), self.manifest_name)
+        return manifest
+
+
+def write_shard(name, header, lines, in_flight):
+    """Write one shard and return its manifest row.
+    """
+    try:
+        data = header + ''.join(lines)
+        with open(name, 'wb') as f:
+            f.write(data)
+        return {
+            'Shard': os.path.basename(name),
+            'Rows': len(lines),
+            'Bytes': len(data),
+            'SHA1': hashlib.sha1(data).hexdigest(),
+        }
+    finally:
+        in_flight.release()
@@ -0,0 +1,121 @@
+"""
+Check that mining_report.py -m keeps the peak memory flat as the number of
+elves grows, and that refreshing the packaged workbook in place over and
+over leaves it intact.  Run from this directory, since it needs colo.csv:
+
+    python -m unittest test_mining_report
+"""
+import os
+import sys
+import csv
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import unittest
+import zipfile
+try:
+    import resource
+except ImportError:
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import mining_report
+
+
+def write_elves(csv_filename, elves, seed=0):
+    """Write a raw mining report with one 2014 row and one 2015 row (in the
+    default date window) for each of elves elves.
+    """
+    with open(os.path.join(HERE, 'colo.csv'), 'rb') as f:
+        gem_types = [row['Gem Type'] for row in csv.DictReader(f)]
+    rand = random.Random(seed)
+    with open(csv_filename, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Elf Name', 'Mining Date', 'Gem Invoice', 'Gem Type',
+                         'Weight', 'Quantity', 'Elf ID', 'Gold'])
+        for i in range(elves):
+            for mining_date in ('2014-05-01', '2015-05-01'):
+                writer.writerow([
+                    'Elf%07d' % i, mining_date, i, rand.choice(gem_types),
+                    '%.2f' % rand.uniform(1, 10), '2.0', i,
+                    '%.3f' % rand.uniform(1, 900)])
+
+
+class TestSpilledMemory(unittest.TestCase):
+
+    MAX_KEYS = 500
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='test_mining_report-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def peak_memory_kb(self, elves):
+        """The largest peak memory mining_report.py -m prints for a report
+        of elves elves.
+        """
+        csv_filename = os.path.join(self.tmp_dir, '%d-elf.csv' % elves)
+        write_elves(csv_filename, elves)
+        output = subprocess.check_output(
+            [sys.executable, 'mining_report.py', '-m', str(self.MAX_KEYS),
+             csv_filename], cwd=HERE, stderr=open(os.devnull, 'wb'))
+        peaks = [int(kb) for kb in re.findall(r'peak memory (\d+) KB', output)]
+        # one for -tgr and one for -ms
+        self.assertEqual(len(peaks), 2)
+        return max(peaks)
+
+    @unittest.skipIf(resource is None, 'no peak memory without resource')
+    def test_flat_peak_memory(self):
+        small = self.peak_memory_kb(2000)
+        big = self.peak_memory_kb(8000)
+        # four times the elves, about the same memory
+        self.assertLess(big, small * 1.25, (small, big))
+
+
+class TestRefreshWorkbook(unittest.TestCase):
+
+    TWBX = 'MiningReport-2015-Q2.twbx'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='test_mining_report-')
+        self.twbx = os.path.join(self.tmp_dir, self.TWBX)
+        shutil.copyfile(os.path.join(HERE, self.TWBX), self.twbx)
+        self.csv_filename = os.path.join(self.tmp_dir, '2015y-elf.csv')
+        self.new_csv_files = list()
+        for name in ['2015y-elf.csv', '2015y-elf-tgr.csv', '2015y-elf-ms.csv']:
+            with open(os.path.join(self.tmp_dir, name), 'wb') as f:
+                f.write('%s\r\n' % name)
+            if name != '2015y-elf.csv':
+                self.new_csv_files.append(os.path.join(self.tmp_dir, name))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_refresh_twice_in_place(self):
+        with zipfile.ZipFile(self.twbx) as twbx:
+            original = dict((info.filename, (info, twbx.read(info)))
+                            for info in twbx.infolist())
+        # the first run adds the csv files, the second replaces them
+        for run in range(2):
+            replacements = mining_report.refresh_workbook(
+                self.twbx, self.csv_filename, self.new_csv_files)
+            self.assertEqual(len(replacements), 3)
+        with zipfile.ZipFile(self.twbx) as twbx:
+            self.assertIsNone(twbx.testzip())
+            for name, (info, data) in original.iteritems():
+                new_info = twbx.getinfo(name)
+                self.assertEqual(twbx.read(name), data)
+                self.assertEqual(new_info.date_time, info.date_time)
+                self.assertEqual(new_info.external_attr, info.external_attr)
+            for member, csv_filename in replacements.iteritems():
+                with open(csv_filename, 'rb') as f:
+                    self.assertEqual(twbx.read(member), f.read())
+            self.assertEqual(len(twbx.namelist()), len(original) + 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,18 +2,25 @@
 Extract certain fields from a csv file and create a new csv.
 """
 import optparse
+import whichdb
 import sys
 import os
 import csv
+import operator
+import threading
+import Queue
 from decimal import Decimal, ROUND_HALF_UP
 import logging
 log = logging.getLogger(__name__)
 from datetime import datetime
+from sharded_csv import ShardedWriter
 
 
 class GetDataSet(object):
     """Extract certain fields from a csv file and create a new csv.
     """
+    # rows with any of these empty are skipped
+    REQUIRED_COLUMNS = ['Name', 'Gross']
 
     def __init__(self, csv_filename, date_start=None, date_end=None):
         self.fieldnames_in = None
@@ -44,7 +51,7 @@ class GetDataSet(object):
         """Keep this row?
         """
         try:
-            for c in (['Name'] + ['Gross']):
+            for c in self.REQUIRED_COLUMNS:
                 if not row[c]:
                     log.info('Skipping row with null %r', c)
                     return False
@@ -81,6 +88,148 @@ class GetDataSet(object):
             self.list_of_dicts.append(row)
         return self.list_of_dicts
 
+    def read_batches(self, batch_rows=1000):
+        """Yield the rows from get_csv_bits in lists of batch_rows.
+        """
+        batch = list()
+        for row in self.get_csv_bits():
+            batch.append(row)
+            if len(batch) >= batch_rows:
+                yield batch
+                batch = list()
+        if batch:
+            yield batch
+
+    def transform_batch(self, batch):
+        """Turn a batch from read_batches into a batch of output rows.
+        """
+        return [self.transform_row(row) for row in batch]
+
+    def transform_row(self, row):
+        """Turn one row from get_csv_bits into one output row.
+        """
+        return row
+
+    def row_writer(self, new_csv):
+        """A csv writer for the rows from transform_batch.
+        """
+        return csv.DictWriter(new_csv, self.fieldnames_out)
+
+    def open_writer(self, new_csv):
+        """Start the new csv with its header row, and return the writer
+        for the batches from transform_batch.
+        """
+        # write the header row out first
+        csv.writer(new_csv).writerow(self.fieldnames_out)
+        return self.row_writer(new_csv)
+
+    def write_new_csv_sharded(self, max_rows=None, max_bytes=None, workers=4):
+        """Like write_new_csv, but into numbered shards of at most
+        max_rows rows or max_bytes bytes, written in parallel, with a
+        manifest.  See ShardedWriter.  Returns the manifest rows.
+        """
+        writer = ShardedWriter(self.new_csv_name, self.fieldnames_out,
+                               self.row_writer, max_rows, max_bytes, workers)
+        try:
+            for batch in self.read_batches():
+                writer.writerows(self.transform_batch(batch))
+            return writer.close()
+        finally:
+            # stop the pool's threads if reading or writing failed
+            writer.pool.terminate()
+
+    def write_new_csv_pipelined(self, batch_rows=1000, queue_batches=8):
+        """Like write_new_csv, but reading, transforming and writing
+        (read_batches, transform_batch and open_writer) run as three
+        stages, joined by queues of batches of rows, so the
+        disk I/O at either end overlaps the transform.  The queues hold at
+        most queue_batches batches, and a full queue holds up the stage
+        before it.  An error in any stage stops the others and is raised
+        here.  The rows are not saved in list_of_dicts.
+        """
+        stop = threading.Event()
+        errors = list()
+        parsed = Queue.Queue(queue_batches)
+        transformed = Queue.Queue(queue_batches)
+
+        def read():
+            for batch in self.read_batches(batch_rows):
+                if not put_or_stop(parsed, batch, stop):
+                    return
+
+        def transform():
+            for batch in get_until_done(parsed, stop):
+                if not put_or_stop(transformed, self.transform_batch(batch),
+                                   stop):
+                    return
+
+        stages = [start_stage(read, parsed, stop, errors),
+                  start_stage(transform, transformed, stop, errors)]
+        lines = 0
+        try:
+            with open(self.new_csv_name, 'wb') as new_csv:
+                writer = self.open_writer(new_csv)
+                for batch in get_until_done(transformed, stop):
+                    writer.writerows(batch)
+                    lines += len(batch)
+        finally:
+            stop.set()
+            for stage in stages:
+                stage.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return lines
+
+
+PIPELINE_DONE = object()
+
+
+def start_stage(target, out_queue, stop, errors):
+    """Run one pipeline stage in a thread, and tell the next stage when
+    it is done.  Any error is saved for the writer to raise, and stops the
+    whole pipeline.
+    """
+    def run():
+        try:
+            target()
+        except BaseException:
+            errors.append(sys.exc_info())
+            stop.set()
+        finally:
+            put_or_stop(out_queue, PIPELINE_DONE, stop)
+    stage = threading.Thread(target=run)
+    stage.daemon = True
+    stage.start()
+    return stage
+
+
+def put_or_stop(queue, item, stop):
+    """Wait for room in the queue, unless the pipeline is stopping.
+    """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def get_until_done(queue, stop):
+    """Yield batches from the queue until the stage before is done, or
+    the pipeline is stopping.
+    """
+    while True:
+        try:
+            item = queue.get(timeout=0.1)
+        except Queue.Empty:
+            if stop.is_set():
+                return
+            continue
+        if item is PIPELINE_DONE:
+            return
+        yield item
+
 
 class SimpleSubset(GetDataSet):
     """Create a data set with a fixed subset of the columns from the
@@ -99,6 +248,88 @@ class SimpleSubset(GetDataSet):
         """
         return super(SimpleSubset, self).keep_me(row)
 
+
+def split_names(names):
+    """Split each name at the last space into first and last names.
+    """
+    first_last = [name.rsplit(' ', 1) for name in names]
+    return [first for first, last in first_last], [last for first, last in first_last]
+
+
+def join_streets(line1s, line2s):
+    """Join the two address lines, if there is a second one.
+    """
+    return ([line1 + ', ' + line2 if line2 else line1
+             for line1, line2 in zip(line1s, line2s)],)
+
+
+class TransactionIndex(object):
+    """The PayPal Transaction IDs already translated, kept in a dbm file
+    so that overlapping exports only turn out the new transactions.  Each
+    Transaction ID maps to its Reference Txn ID, the original payment for a
+    refund or reversal, or ''.  New IDs only go into the file with commit,
+    once the new csv has been written.
+
+    Needs dbhash or gdbm: the dumbdbm that anydbm falls back to rewrites
+    its whole directory file on every sync and is no good for a big index.
+    """
+    DBM_MODULES = ['dbhash', 'gdbm']
+
+    def __init__(self, index_filename):
+        self.index_filename = index_filename
+        self.db = self.open_db(index_filename)
+        self.pending = dict()
+        self.skipped = 0
+
+    def is_new(self, txn_id, ref_txn_id=''):
+        """Is this a transaction we have not seen before?  If so, it is
+        noted for the next commit.  Rows without a Transaction ID are
+        always new.
+        """
+        if not txn_id:
+            return True
+        if txn_id in self.pending or self.db.has_key(txn_id):
+            self.skipped += 1
+            return False
+        self.pending[txn_id] = ref_txn_id
+        return True
+
+    def open_db(self, index_filename):
+        """Open the index with the dbm module that made it, or create it
+        with the first of DBM_MODULES this Python has.
+        """
+        kind = whichdb.whichdb(index_filename)
+        if kind is None:
+            for kind in self.DBM_MODULES:
+                try:
+                    return __import__(kind).open(index_filename, 'c')
+                except ImportError:
+                    pass
+            sys.exit('The index needs one of the %s modules, which this '
+                     'Python does not have' % ' or '.join(self.DBM_MODULES))
+        if kind not in self.DBM_MODULES:
+            sys.exit('%r is a %s file, not one of %s' % (
+                index_filename, kind or 'unknown',
+                ', '.join(self.DBM_MODULES)))
+        try:
+            return __import__(kind).open(index_filename, 'w')
+        except ImportError:
+            sys.exit('%r is a %s file, and this Python has no %s module' % (
+                index_filename, kind, kind))
+
+    def commit(self):
+        for txn_id, ref_txn_id in self.pending.iteritems():
+            self.db[txn_id] = ref_txn_id
+        if hasattr(self.db, 'sync'):
+            self.db.sync()
+        log.info('Added %r transactions to %r', len(self.pending),
+                 self.index_filename)
+        self.pending = dict()
+
+    def close(self):
+        self.db.close()
+
+
 class PayPalTransactions(GetDataSet):
     """Translate a csv file created by exporting transactions from
     Paypal into a csv file that conforms to the NPSP Data Import Template
@@ -220,48 +451,173 @@ class PayPalTransactions(GetDataSet):
         'Payment Method',
     ]
 
-    def __init__(self, csv_filename, date_start, date_end):
+    # How the NPSP columns are filled in from the PayPal columns: each entry
+    # is (NPSP columns, PayPal columns, batch function).  Without a function
+    # the PayPal column is copied as it is.  A batch function gets one list
+    # per PayPal column, with the values for every row in the batch, and
+    # returns one list per NPSP column.  NPSP columns not here are blank.
+    NPSP_MAPPING = [
+        (['Contact1 First Name', 'Contact1 Last Name'], ['Name'],
+         split_names),
+        (['Contact1 Personal Email'], ['From Email Address'], None),
+        (['Home Street'], ['Address Line 1', 'Address Line 2/District'],
+         join_streets),
+        (['Home City'], ['Town/City'], None),
+        (['Home State/Province'], ['State/Province'], None),
+        (['Home Zip/Postal Code'], ['Zip/Postal Code'], None),
+        (['Home Country'], ['Country'], None),
+        (['Donation Amount'], ['Gross'], None),
+        (['Donation Date'], ['Date'], None),
+        (['Donation Type'], ['Type'], None),
+        (['Donation Description'], ['Note'], None),
+    ]
+
+    def __init__(self, csv_filename, date_start, date_end, index=None):
         super(PayPalTransactions, self).__init__(csv_filename, date_start, date_end)
+        # a TransactionIndex, to skip the rows already imported
+        self.index = index
         self.fieldnames_in = self.PAYPAL_COLUMNS
         self.fieldnames_out = self.NPSP_COLUMNS
         self.new_csv_name = os.path.splitext(self.csv_filename)[0] + '-npsp.csv'
         self.get_rows = self.get_paypal_rows
-
-    def keep_me(self, row):
-        """Could be slightly different.
-        """
-        return super(PayPalTransactions, self).keep_me(row)
+        self.compiled_header = None
 
     def get_paypal_rows(self):
         """Yield one dict output row at a time.
         """
-        for row in self.get_csv_bits():
-            output_row = dict.fromkeys(self.NPSP_COLUMNS, '')
-            output_row['Donation Date'] = row['Date']
-            first, last = row['Name'].rsplit(' ', 1)
-            output_row['Contact1 First Name'] = first
-            output_row['Contact1 Last Name'] = last
-            output_row['Donation Type'] = row['Type']
-            output_row['Donation Amount'] = row['Gross']
-            output_row['Contact1 Personal Email'] = row['From Email Address']
-            output_row['Donation Description'] = row['Note']
-            output_row['Home Street'] = row['Address Line 1']
-            if row['Address Line 2/District']:
-                output_row['Home Street'] += ', ' + row['Address Line 2/District']
-            output_row['Home City'] = row['Town/City']
-            output_row['Home State/Province'] = row['State/Province']
-            output_row['Home Zip/Postal Code'] = row['Zip/Postal Code']
-            output_row['Home Country'] = row['Country']
-            yield output_row
-
-
-
-def translate_paypal(csv_filename, start_date, end_date):
+        for batch in self.read_batches():
+            for output_row in self.transform_batch(batch):
+                yield dict(zip(self.NPSP_COLUMNS, output_row))
+
+    def compile_mapping(self, header):
+        """Turn NPSP_MAPPING into positions in the PayPal header, once per
+        file.  Each output row is then one itemgetter call on the input row
+        with the computed values and a blank added on the end.
+        """
+        position = lambda column: self.column_position(header, column)
+        self.required = [position(c) for c in self.REQUIRED_COLUMNS]
+        self.width = len(header)
+        self.computed = list()
+        sources = dict()
+        extended = len(header)
+        for npsp_columns, paypal_columns, function in self.NPSP_MAPPING:
+            positions = [position(c) for c in paypal_columns]
+            if function is None:
+                sources[npsp_columns[0]] = positions[0]
+                continue
+            self.computed.append((function, positions))
+            for c in npsp_columns:
+                sources[c] = extended
+                extended += 1
+        # the blank for every NPSP column not in the mapping
+        blank = extended
+        self.make_output_row = operator.itemgetter(
+            *[sources.get(c, blank) for c in self.NPSP_COLUMNS])
+        self.compiled_header = header
+
+    def column_position(self, header, column):
+        try:
+            return header.index(column)
+        except ValueError:
+            log.error("There is no %s in this data." % column)
+            raise KeyError(column)
+
+    def read_batches(self, batch_rows=1000):
+        """Yield lists of up to batch_rows PayPal rows, as lists in the
+        order of the header and cut or padded to its width, skipping the
+        ones with a null REQUIRED_COLUMNS value, as keep_me does, and, with
+        an index, the ones already imported.
+        """
+        with open(self.csv_filename, 'rb') as f:
+            reader = csv.reader(f)
+            try:
+                header = next(reader)
+                if header != self.compiled_header:
+                    self.compile_mapping(header)
+                required = self.required
+                width = self.width
+                index = self.index
+                if index is not None:
+                    txn_id = self.column_position(header, 'Transaction ID')
+                    ref_txn_id = self.column_position(header, 'Reference Txn ID')
+                batch = list()
+                for row in reader:
+                    if len(row) < width:
+                        row.extend([''] * (width - len(row)))
+                    del row[width:]
+                    for i in required:
+                        if not row[i]:
+                            log.info('Skipping row with null %r', header[i])
+                            break
+                    else:
+                        if (index is not None and
+                                not index.is_new(row[txn_id], row[ref_txn_id])):
+                            continue
+                        batch.append(row)
+                        if len(batch) >= batch_rows:
+                            yield batch
+                            batch = list()
+                if batch:
+                    yield batch
+            except csv.Error as e:
+                sys.exit('line %d: %s' % (reader.line_num, e))
+
+    def transform_batch(self, batch):
+        """Translate a batch of PayPal rows into NPSP tuples, working out
+        the computed columns a whole batch at a time.
+        """
+        columns = list()
+        for function, positions in self.computed:
+            columns.extend(function(*[[row[i] for row in batch]
+                                      for i in positions]))
+        columns.append([''] * len(batch))
+        make_output_row = self.make_output_row
+        output = list()
+        for row, values in zip(batch, zip(*columns)):
+            row.extend(values)
+            output.append(make_output_row(row))
+        return output
+
+    def row_writer(self, new_csv):
+        return csv.writer(new_csv)
+
+    def write_new_csv(self):
+        """Write out the new csv a batch at a time, without keeping the
+        rows in list_of_dicts.
+        """
+        lines = 0
+        with open(self.new_csv_name, 'wb') as new_csv:
+            writer = self.open_writer(new_csv)
+            for batch in self.read_batches():
+                writer.writerows(self.transform_batch(batch))
+                lines += len(batch)
+        return lines
+
+
+def translate_paypal(csv_filename, start_date, end_date, pipeline=False,
+                     index_filename=None, shard_rows=None, shard_bytes=None):
     """Do the translation.
     """
-    data_set = PayPalTransactions(csv_filename, start_date, end_date)
-    lines = data_set.write_new_csv()
-    print "wrote %r lines to %r" % (lines, data_set.new_csv_name)
+    index = TransactionIndex(index_filename) if index_filename else None
+    try:
+        data_set = PayPalTransactions(csv_filename, start_date, end_date, index)
+        if shard_rows or shard_bytes:
+            manifest = data_set.write_new_csv_sharded(shard_rows, shard_bytes)
+            for shard in manifest:
+                print "wrote %r lines to %r" % (shard['Rows'], shard['Shard'])
+        elif pipeline:
+            lines = data_set.write_new_csv_pipelined()
+            print "wrote %r lines to %r" % (lines, data_set.new_csv_name)
+        else:
+            lines = data_set.write_new_csv()
+            print "wrote %r lines to %r" % (lines, data_set.new_csv_name)
+        if index:
+            # only now that the new csv is all there
+            index.commit()
+            print "skipped %r transactions already imported" % index.skipped
+    finally:
+        if index:
+            index.close()
 
 
 def main():
@@ -294,6 +650,33 @@ def main():
         default=DATE_END,
         help='Exclusive end date.',
     )
+    parser.add_option(
+        '-r',
+        '--shard_rows',
+        type='int',
+        default=None,
+        help='Split the output into files of at most this many rows.',
+    )
+    parser.add_option(
+        '-b',
+        '--shard_mb',
+        type='float',
+        default=None,
+        help='Split the output into files of at most this many MB.',
+    )
+    parser.add_option(
+        '-x',
+        '--index',
+        default=None,
+        help='Skip, and remember, the Transaction IDs in this index file.',
+    )
+    parser.add_option(
+        '-p',
+        '--pipeline',
+        action='store_true',
+        dest='pipeline',
+        help='Read, translate and write in separate threads.',
+    )
     (opts, args) = parser.parse_args()
     # if opts.note:
     #     show_notes()
@@ -306,7 +689,9 @@ def main():
         # raise optparse.BadOptionError('CSV file name required.')
 
     # make_simple_subset(args[0], opts.start_date, opts.end_date)
-    translate_paypal(args[0], opts.start_date, opts.end_date)
+    shard_bytes = int(opts.shard_mb * 1024 * 1024) if opts.shard_mb else None
+    translate_paypal(args[0], opts.start_date, opts.end_date, opts.pipeline,
+                     opts.index, opts.shard_rows, shard_bytes)
 
 
 if __name__ == '__main__':